@@ -1,23 +1,151 @@
+import heapq
+import math
 import os
 import random
+import threading
+import time
 import requests
-from datetime import datetime, timezone
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+
+def _positive_float_env(name: str, default: str) -> float:
+    # Env var als getal > 0 lezen, anders duidelijk stoppen
+    raw = os.environ.get(name, default)
+    try:
+        value = float(raw)
+    except ValueError:
+        value = 0.0
+    if not 0 < value < math.inf:
+        raise RuntimeError(f"{name} moet een getal groter dan 0 zijn (nu: {raw!r}).")
+    return value
 
 
 BLUESKY_BASE_URL = "https://bsky.social"
 
+# Aantal posts waarvan we tegelijk de oude repost opruimen
+MAX_WORKERS = 8
+
+# Een Retry-After header van de server nooit langer volgen dan dit
+RETRY_AFTER_MAX_WAIT = 60
+
+
+class CappedRetry(Retry):
+    """
+    urllib3 Retry die op een Retry-After header maximaal RETRY_AFTER_MAX_WAIT
+    seconden wacht (urllib3 zelf kent geen bovengrens).
+    """
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, RETRY_AFTER_MAX_WAIT)
+
+
+# Lezen is veilig om te herhalen: bij rate limiting (429), tijdelijke
+# serverfouten en read errors opnieuw proberen, met exponential backoff
+READ_RETRY_POLICY = CappedRetry(
+    total=5,
+    backoff_factor=0.5,
+    status_forcelist=[429, 500, 502, 503, 504],
+    allowed_methods=frozenset(["GET"]),
+    respect_retry_after_header=True,
+    # Na de laatste poging de response teruggeven, raise_for_status doet de rest
+    raise_on_status=False,
+)
+
+class WriteRetry(CappedRetry):
+    """
+    CappedRetry voor schrijf-calls. urllib3 herhaalt standaard ook een 413 of
+    503 met Retry-After header; voor writes mag dat alleen bij een 429.
+    """
+
+    RETRY_AFTER_STATUS_CODES = frozenset({429})
+
+
+# Schrijven niet: na een 5xx (ook een 503 met Retry-After) of een timeout kan
+# de write al doorgevoerd zijn en levert nog een poging dubbele reposts op.
+# Alleen 429 (niet verwerkt) en connect errors (nog niks verstuurd) opnieuw
+# proberen.
+WRITE_RETRY_POLICY = WriteRetry(
+    total=5,
+    read=0,
+    other=0,
+    backoff_factor=0.5,
+    status_forcelist=[429],
+    allowed_methods=frozenset(["POST"]),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+# app.bsky.feed.getAuthorFeed geeft maximaal 100 items per pagina
+AUTHOR_FEED_PAGE_LIMIT = 100
+
+# app.bsky.feed.getPosts accepteert maximaal 25 uris per call
+GET_POSTS_MAX_URIS = 25
+
+# Schrijf-calls (applyWrites/createRecord/deleteRecord) zelf afremmen: gemiddeld
+# zoveel per seconde, met korte bursts tot BSKY_REQ_BURST
+WRITE_RATE_PER_SEC = _positive_float_env("BSKY_REQ_RPS", "8")
+WRITE_BURST = _positive_float_env("BSKY_REQ_BURST", "16")
+
+# Als de server meldt dat er bijna geen schrijf-budget meer over is, wachten
+# tot de reset, maar nooit langer dan dit (anders laten we de server weigeren)
+RATELIMIT_MIN_REMAINING = 5
+RATELIMIT_MAX_WAIT = 60
+
+IMAGES_EMBED_VIEW = "app.bsky.embed.images#view"
+RECORD_WITH_MEDIA_EMBED_VIEW = "app.bsky.embed.recordWithMedia#view"
+
+
+class TokenBucket:
+    """
+    Simpele thread-safe token bucket: gemiddeld `rate` acquires per seconde,
+    met bursts tot `capacity`.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Token meteen reserveren; een negatief saldo is de wachtrij
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+
 
 class BlueskyClient:
     def __init__(self, identifier: str, password: str):
         self.identifier = identifier
         self.password = password
+        # Aparte sessions voor lezen en schrijven, elk met een eigen retry-beleid
         self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(max_retries=READ_RETRY_POLICY))
+        self.write_session = requests.Session()
+        self.write_session.mount("https://", HTTPAdapter(max_retries=WRITE_RETRY_POLICY))
+        self.write_bucket = TokenBucket(WRITE_RATE_PER_SEC, WRITE_BURST)
+        # Laatst gemelde ratelimit-remaining / ratelimit-reset van schrijf-calls
+        self.ratelimit_remaining: int | None = None
+        self.ratelimit_reset: float | None = None
         self.did = None
         self.access_jwt = None
 
     def login(self):
         url = f"{BLUESKY_BASE_URL}/xrpc/com.atproto.server.createSession"
-        resp = self.session.post(
+        resp = self.write_session.post(
             url,
             json={"identifier": self.identifier, "password": self.password},
             timeout=30,
@@ -26,7 +154,9 @@ class BlueskyClient:
         data = resp.json()
         self.access_jwt = data["accessJwt"]
         self.did = data["did"]
-        self.session.headers.update({"Authorization": f"Bearer {self.access_jwt}"})
+        auth = {"Authorization": f"Bearer {self.access_jwt}"}
+        self.session.headers.update(auth)
+        self.write_session.headers.update(auth)
 
     def _get(self, path: str, params: dict | None = None):
         url = f"{BLUESKY_BASE_URL}{path}"
@@ -35,11 +165,39 @@ class BlueskyClient:
         return resp.json()
 
     def _post(self, path: str, payload: dict):
+        self._wait_for_ratelimit()
+        self.write_bucket.acquire()
         url = f"{BLUESKY_BASE_URL}{path}"
-        resp = self.session.post(url, json=payload, timeout=30)
+        resp = self.write_session.post(url, json=payload, timeout=30)
+        self._record_ratelimit(resp)
         resp.raise_for_status()
         return resp.json()
 
+    def _record_ratelimit(self, resp: requests.Response):
+        remaining = resp.headers.get("ratelimit-remaining")
+        reset = resp.headers.get("ratelimit-reset")
+        try:
+            if remaining is not None:
+                self.ratelimit_remaining = int(remaining)
+            if reset is not None:
+                self.ratelimit_reset = float(reset)
+        except ValueError:
+            # Onverwacht formaat, dan gewoon niet op de headers sturen
+            pass
+
+    def _wait_for_ratelimit(self):
+        """
+        Wacht tot de ratelimit-reset als het schrijf-budget bijna op is.
+        """
+        if self.ratelimit_remaining is None or self.ratelimit_reset is None:
+            return
+        if self.ratelimit_remaining > RATELIMIT_MIN_REMAINING:
+            return
+
+        wait = self.ratelimit_reset - time.time()
+        if 0 < wait <= RATELIMIT_MAX_WAIT:
+            time.sleep(wait)
+
     def get_own_media_posts(self, max_posts: int = 200):
         """
         Haal eigen posts met images op (geen reposts).
@@ -50,8 +208,10 @@ class BlueskyClient:
 
         while len(posts) < max_posts:
             params = {
-                "actor": self.identifier,
-                "limit": 100,
+                # DID uit de login gebruiken: geen handle-resolutie op de server,
+                # en werkt ook als er met een e-mailadres is ingelogd
+                "actor": self.did,
+                "limit": AUTHOR_FEED_PAGE_LIMIT,
                 "filter": "posts_with_media",
             }
             if cursor:
@@ -59,6 +219,8 @@ class BlueskyClient:
 
             data = self._get("/xrpc/app.bsky.feed.getAuthorFeed", params=params)
             feed = data.get("feed", [])
+            if not feed:
+                break
 
             for item in feed:
                 # Skip reposts (feed items met "reason" zijn meestal reposts)
@@ -76,13 +238,14 @@ class BlueskyClient:
 
                 # Check of er überhaupt images inzitten
                 embed = post.get("embed") or {}
+                embed_type = embed.get("$type")
                 has_images = False
 
-                if embed.get("$type") == "app.bsky.embed.images#view":
+                if embed_type == IMAGES_EMBED_VIEW:
                     has_images = True
-                elif embed.get("$type") == "app.bsky.embed.recordWithMedia#view":
+                elif embed_type == RECORD_WITH_MEDIA_EMBED_VIEW:
                     media = embed.get("media") or {}
-                    if media.get("$type") == "app.bsky.embed.images#view":
+                    if media.get("$type") == IMAGES_EMBED_VIEW:
                         has_images = True
 
                 if not has_images:
@@ -110,18 +273,21 @@ class BlueskyClient:
 
         return posts
 
-    def get_repost_uri_for_post(self, uri: str) -> str | None:
+    def get_repost_uris_for_posts(self, uris: list[str]) -> dict[str, str | None]:
         """
-        Kijkt of WIJ deze post al eens gerepost hebben.
-        Als ja, dan zit er in viewer.repost een uri van onze repost-record.
+        Kijkt of WIJ deze posts al eens gerepost hebben, in zo min mogelijk
+        calls. Returned dict van post-uri naar onze repost-uri uit viewer.repost
+        (of None als we die post niet gerepost hebben).
         """
-        data = self._get("/xrpc/app.bsky.feed.getPosts", params={"uris": uri})
-        posts = data.get("posts", [])
-        if not posts:
-            return None
+        repost_uris: dict[str, str | None] = {}
+        for i in range(0, len(uris), GET_POSTS_MAX_URIS):
+            chunk = uris[i : i + GET_POSTS_MAX_URIS]
+            data = self._get("/xrpc/app.bsky.feed.getPosts", params={"uris": chunk})
+            for post in data.get("posts", []):
+                viewer = post.get("viewer") or {}
+                repost_uris[post["uri"]] = viewer.get("repost")
 
-        viewer = posts[0].get("viewer") or {}
-        return viewer.get("repost")
+        return repost_uris
 
     def delete_repost_by_uri(self, repost_uri: str):
         """
@@ -142,7 +308,7 @@ class BlueskyClient:
         """
         Maak een nieuwe repost-record aan.
         """
-        now = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+        now = utc_now_iso()
         payload = {
             "repo": self.did,
             "collection": "app.bsky.feed.repost",
@@ -154,23 +320,96 @@ class BlueskyClient:
         }
         self._post("/xrpc/com.atproto.repo.createRecord", payload)
 
-    def ensure_fresh_repost(self, subject_uri: str, subject_cid: str):
+    def refresh_reposts(self, posts: list[dict], existing: dict[str, str | None]):
         """
-        Zorgt dat we eerst de oude repost verwijderen (alleen als die bestaat),
-        en dan opnieuw repost doen.
+        Verwijder de bestaande reposts en maak ze opnieuw aan, allemaal in één
+        applyWrites-call. Die is atomair: alles lukt of er verandert niks.
+        De volgorde van `posts` is de volgorde waarin de reposts in de feed komen.
         """
-        existing_repost_uri = self.get_repost_uri_for_post(subject_uri)
-        if existing_repost_uri:
-            # Alleen de repost van deze post verwijderen
-            self.delete_repost_by_uri(existing_repost_uri)
+        writes: list[dict] = []
+        for post in posts:
+            repost_uri = existing.get(post["uri"])
+            if repost_uri:
+                writes.append(
+                    {
+                        "$type": "com.atproto.repo.applyWrites#delete",
+                        "collection": "app.bsky.feed.repost",
+                        "rkey": repost_uri.split("/")[-1],
+                    }
+                )
+
+        # Alles in dezelfde commit: createdAt per repost 1 ms verder zetten,
+        # anders is de volgorde in de feed niet gegarandeerd
+        base = datetime.now(timezone.utc)
+        for i, post in enumerate(posts):
+            writes.append(
+                {
+                    "$type": "com.atproto.repo.applyWrites#create",
+                    "collection": "app.bsky.feed.repost",
+                    "value": {
+                        "$type": "app.bsky.feed.repost",
+                        "subject": {"uri": post["uri"], "cid": post["cid"]},
+                        "createdAt": format_iso(base + timedelta(milliseconds=i)),
+                    },
+                }
+            )
+
+        self._post(
+            "/xrpc/com.atproto.repo.applyWrites",
+            {"repo": self.did, "writes": writes},
+        )
+
+
+def format_iso(dt: datetime) -> str:
+    # Altijd microseconden en 'Z', zodat createdAt's onderling goed sorteren
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
 
-        # Daarna opnieuw repost
-        self.create_repost(subject_uri, subject_cid)
+
+def utc_now_iso() -> str:
+    return format_iso(datetime.now(timezone.utc))
 
 
 def parse_iso(dt: str) -> datetime:
     # Bluesky timestamps zijn meestal ISO8601 met 'Z' op het eind
-    return datetime.fromisoformat(dt.replace("Z", "+00:00"))
+    parsed = datetime.fromisoformat(dt.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        # Zonder tijdzone kunnen we niet vergelijken met de rest, dus UTC aannemen
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def plan_repost_sequence(posts: list[dict], rng: random.Random) -> list[dict]:
+    """
+    Bepaal welke posts we reposten en in welke volgorde (maximaal 20):
+    1. 10 random oude posts
+    2. de nieuwste 10 van oud -> nieuw (zodat de aller-nieuwste als laatste
+       bovenaan komt)
+    """
+    # Elke timestamp maar één keer parsen. Niet als string vergelijken: de
+    # precisie van de fracties verschilt per client.
+    decorated = [(parse_iso(p["createdAt"]), i, p) for i, p in enumerate(posts)]
+
+    # Alleen de nieuwste 10 hoeven echt gesorteerd; als er minder dan 10 posts
+    # zijn, gewoon zoveel mogelijk doen. De index i zorgt dat gelijke timestamps
+    # nooit op de dicts zelf vergeleken worden.
+    newest = sorted(heapq.nlargest(10, decorated))
+    newest_10 = [p for _, _, p in newest]
+    newest_uris = {p["uri"] for p in newest_10}
+    older_pool = [p for p in posts if p["uri"] not in newest_uris]
+
+    # 10 random oude posts (als er minder zijn, dan zoveel als er zijn).
+    # sample geeft ze al in random volgorde terug.
+    old_random = rng.sample(older_pool, min(10, len(older_pool)))
+
+    return old_random + newest_10
+
+
+def _delete_repost_quietly(client: BlueskyClient, repost_uri: str | None) -> bool:
+    try:
+        client.delete_repost_by_uri(repost_uri)
+    except Exception:
+        return False
+    return True
 
 
 def main():
@@ -188,41 +427,52 @@ def main():
     if not posts:
         return
 
-    # 2) Sorteren op createdAt (oud -> nieuw)
-    posts_sorted = sorted(posts, key=lambda p: parse_iso(p["createdAt"]))
-
-    # Als er minder dan 10 posts zijn, gewoon zoveel mogelijk doen
-    newest_10 = posts_sorted[-10:] if len(posts_sorted) >= 10 else posts_sorted[:]
-    older_pool = posts_sorted[:-10] if len(posts_sorted) > 10 else []
-
-    # 10 random oude posts (als er minder zijn, dan zoveel als er zijn)
-    if older_pool:
-        if len(older_pool) > 10:
-            old_random = random.sample(older_pool, 10)
-        else:
-            old_random = older_pool[:]
-        random.shuffle(old_random)  # random volgorde oude posts
-    else:
-        old_random = []
-
-    # Nieuwste 10 van oud -> nieuw (dus zoals posts_sorted al is)
-    newest_10_sorted = sorted(newest_10, key=lambda p: parse_iso(p["createdAt"]))
-
-    # Volgorde:
-    # 1. 10 random oude
-    # 2. nieuwsten 10 van oud -> nieuw (zodat de aller-nieuwste als laatste bovenaan komt)
-    final_sequence = old_random + newest_10_sorted
-
-    # Alleen maximaal 20 reposts per run (10 oud + 10 nieuw)
-    final_sequence = final_sequence[:20]
-
-    for post in final_sequence:
-        uri = post["uri"]
-        cid = post["cid"]
+    # 2) Geseed per uur, zodat meerdere runs binnen hetzelfde uur dezelfde
+    # oude posts kiezen i.p.v. elk weer andere posts te reposten
+    rng = random.Random(int(time.time()) // 3600)
+    final_sequence = plan_repost_sequence(posts, rng)
+
+    # Bestaande reposts van alle posts in één keer opvragen
+    try:
+        existing = client.get_repost_uris_for_posts([p["uri"] for p in final_sequence])
+    except Exception:
+        return
+
+    # Alles in één applyWrites-call
+    try:
+        client.refresh_reposts(final_sequence, existing)
+        return
+    except requests.HTTPError as e:
+        status = e.response.status_code if e.response is not None else None
+        if status is None or not 400 <= status < 500 or status == 429:
+            # 5xx (bv. een 502/504 van de gateway) kan komen nadat de PDS de
+            # commit al heeft doorgevoerd, en bij 429 maakt per post het alleen
+            # erger: dan niet nog eens proberen
+            return
+        # Een 4xx (bv. een PDS met een lagere applyWrites-limiet) betekent dat de
+        # PDS de call geweigerd heeft; omdat die atomair is, is er dan niks
+        # veranderd en kunnen we het per post doen
+    except Exception:
+        # Onbekend of de writes zijn doorgevoerd, dus niet nog eens proberen
+        return
+
+    # Oude reposts opruimen is per post onafhankelijk, dus dat doen we parallel
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        removed = list(
+            executor.map(
+                lambda p: _delete_repost_quietly(client, existing.get(p["uri"])),
+                final_sequence,
+            )
+        )
+
+    # Nieuwe reposts wel één voor één, zodat de volgorde in de feed klopt
+    for post, ok in zip(final_sequence, removed):
+        if not ok:
+            # Geen logging/boekhouding bijhouden, dus fouten gewoon negeren
+            continue
         try:
-            client.ensure_fresh_repost(uri, cid)
+            client.create_repost(post["uri"], post["cid"])
         except Exception:
-            # Geen logging/boekhouding bijhouden, dus fouten gewoon negeren
             continue
 
 